@@ -5,12 +5,17 @@
 
 __author__ = "Lisa Koeritz"
 
+import functools
+import os
+import numpy as np
 import pandas as pd
 import re
-from dateutil.relativedelta import relativedelta
+from concurrent.futures import ThreadPoolExecutor
 
 TO_PERCENT = 100
 
+WEEK_NS = pd.Timedelta(weeks=1).value
+
 def describe_dc_as_dataframe(dc: pd.Series, ds_md: dict) -> pd.Series:
     """ describes the profile criteria for column
     Args:
@@ -20,9 +25,17 @@ def describe_dc_as_dataframe(dc: pd.Series, ds_md: dict) -> pd.Series:
         A Series containing calculated description values.
     """
     dc = pd.to_numeric(dc, errors='coerce')
-    null_values = dc.isna().sum()
-    unique_values = len(dc.dropna().unique()) / len(dc)
-    constancy = dc.value_counts(normalize=True).max() #constancy defined as amount of most frequent value divided by amount of numbers in column
+    clean = dc.dropna()
+    value_counts = clean.value_counts() # sorted descending
+    null_values = len(dc) - len(clean)
+    unique_values = len(value_counts) / len(dc)
+    constancy = (value_counts.iloc[0] / len(clean)) if len(clean) > 0 else np.nan #constancy defined as amount of most frequent value divided by amount of numbers in column
+    minimum, maximum = "", ""
+    if len(clean) > 0:
+        values = clean.to_numpy()
+        i_min, i_max = values.argmin(), values.argmax()
+        minimum = {clean.index[i_min].date(): format(values[i_min], 'f')}
+        maximum = {clean.index[i_max].date(): format(values[i_max], 'f')}
 
     dc_stats = [
         ["Metadaten spezifisch für Spalte", column_metadata(dc.name, ds_md)],
@@ -31,9 +44,9 @@ def describe_dc_as_dataframe(dc: pd.Series, ds_md: dict) -> pd.Series:
         ["Fehlende Werte (Prozent)", (null_values / len(dc))*TO_PERCENT],
         ["Distinkte Werte (Prozent)", unique_values*TO_PERCENT],
         ["Konstanz (Prozent)", constancy*TO_PERCENT],
-        ["Mittelwert", format(dc.mean(), 'f')],
-        ["Minimumwert (Jahr, Wert)", ({dc.idxmin().date(): format(dc.min(), 'f')} if len(dc.dropna()) > 0 else "")],
-        ["Maximumwert (Jahr, Wert)", ({dc.idxmax().date(): format(dc.max(), 'f')}  if len(dc.dropna()) > 0 else "")],
+        ["Mittelwert", format(clean.mean(), 'f')],
+        ["Minimumwert (Jahr, Wert)", minimum],
+        ["Maximumwert (Jahr, Wert)", maximum],
         ["Datenpunkte vorhanden für", check_is_consecutive(dc)]
     ]
 
@@ -42,6 +55,18 @@ def describe_dc_as_dataframe(dc: pd.Series, ds_md: dict) -> pd.Series:
 
     return profile
 
+def profile_all_columns(ds: pd.DataFrame, ds_md: dict) -> dict:
+    """ describes the profile criteria for every column of the dataset, columns are profiled in parallel
+    Args:
+        ds: the DataFrame to create column profiles for
+        ds_md: the Metadata dictionary of the DataFrame that is to be profiled
+    Returns:
+        A dict with column names as keys and their column profile as values
+    """
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        profiles = executor.map(lambda column: describe_dc_as_dataframe(ds[column], ds_md), ds.columns)
+        return dict(zip(ds.columns, profiles))
+
 # prototypical solution
 def column_metadata(dc_name: str, ds_md: dict) -> str:
     """ extracts metadata description given by database explicitly for parameter series
@@ -52,11 +77,21 @@ def column_metadata(dc_name: str, ds_md: dict) -> str:
         descriptive meta-information given for series
     """
     if ds_md["Beschreibung"] and dc_name in ds_md["Beschreibung"]:
-        result = re.search('%s([^\n]*)' % dc_name, ds_md["Beschreibung"])
+        result = _metadata_pattern(dc_name).search(ds_md["Beschreibung"])
         return result.group(0)
     else:
         return ""
 
+@functools.lru_cache(maxsize=None)
+def _metadata_pattern(dc_name: str):
+    """ compiles the pattern matching the rest of the description line starting at the column name
+    Args:
+        dc_name: the column name to search for
+    Returns:
+        compiled regular expression with the column name escaped
+    """
+    return re.compile(re.escape(dc_name) + '([^\n]*)')
+
 def check_is_consecutive(dc: pd.Series) -> list:
     """ creates list of consecutive intervals for which datapoints are given in Series
     Args:
@@ -65,25 +100,38 @@ def check_is_consecutive(dc: pd.Series) -> list:
         A list containing all intervals of consecutive dates in formatted output
     """
     interval_list = []
-    col = list(dc.dropna().index)  # list of all dates with values
+    col = dc.dropna().index.sort_values()  # all dates with values
     try:
-        start = col[-1]  # last list item
-        end = col[0]
+        gaps = np.array([], dtype=int)
         if len(col) > 2:
             interval = pd.infer_freq(dc.index) # frequency can only be provided when more than two items
             if interval:
-                delta = (relativedelta(years=1) if interval == "AS-JAN" else (
-                    relativedelta(months=1) if interval == "MS" else relativedelta(weeks=1)))
-                while len(col) > 1:
-                    d2 = col.pop()
-                    d3 = col[-1] + delta
-                    if d3 != d2:
-                        date_period = (str(d2.to_period('D')), str(start.to_period('D')))
-                        interval_list.append(" - ".join(date_period))
-                        start = col[-1]
-        date_period = (str(end.to_period('D')), str(start.to_period('D')))
-        interval_list.append(" - ".join(date_period))
-        interval_list.reverse()
-    except:
-        pass
+                gaps = _find_gaps(col, interval)
+        starts = np.concatenate(([0], gaps + 1))
+        ends = np.concatenate((gaps, [len(col) - 1]))
+        for start, end in zip(starts, ends):
+            date_period = (str(col[start].to_period('D')), str(col[end].to_period('D')))
+            interval_list.append(" - ".join(date_period))
+    except (AttributeError, IndexError, TypeError, ValueError):
+        interval_list = []
     return interval_list
+
+def _find_gaps(col: pd.DatetimeIndex, interval: str) -> np.ndarray:
+    """ finds the positions after which the next date is not the expected successor for the given frequency
+    Args:
+        col: the sorted dates to check
+        interval: frequency of the Series as inferred by pandas
+    Returns:
+        A numpy array with the positions of the last date before each gap
+    """
+    # compare integer steps: years for annual, calendar months for monthly and nanoseconds for all other data
+    if interval == "AS-JAN":
+        ordinals = col.year.values
+        step = 1
+    elif interval == "MS":
+        ordinals = col.year.values * 12 + col.month.values
+        step = 1
+    else:
+        ordinals = col.asi8
+        step = WEEK_NS
+    return np.flatnonzero(np.diff(ordinals) != step)
@@ -5,8 +5,10 @@
 
 __author__ = "Lisa Koeritz"
 
+import functools
 import logging
 import pandas as pd
+from pandas.api.types import is_categorical_dtype
 from pandas.api.types import is_numeric_dtype
 from pandas.api.types import is_string_dtype
 import numpy as np
@@ -18,6 +20,8 @@ import utils
 
 TO_PERCENT = 100
 KB = 1024.0
+CATEGORY_RATIO = 0.5
+AGGREGATION_RTOL = 1e-3 # relative tolerance for rounded World figures
 
 REGION_CODE = {
     2: "Africa",
@@ -59,6 +63,11 @@ def describe_ds_as_dataframe(ds: pd.DataFrame, ds_md: dict) -> pd.DataFrame:
     Returns:
         A pandas DataFrame containing calculated description values.
     """
+    memory_size = get_memory_size(ds)
+    ds = _categorize_object_columns(ds)
+    # one numeric version of the dataset and its missing value mask, shared by the value checks
+    numeric = _numeric_frame(ds)
+    na = numeric.isna()
     no_country, iso = check_domain(ds)
     geo = check_regions(iso)
 
@@ -69,15 +78,15 @@ def describe_ds_as_dataframe(ds: pd.DataFrame, ds_md: dict) -> pd.DataFrame:
         ["Zeitliche Granularität", check_interval(ds)],
         ["Anzahl der Zeilen", ds.index.size],
         ["Anzahl der Spalten", ds.columns.size],
-        ["Datengröße in Kilobytes", get_memory_size(ds)],
-        ["Distinkte Werte (Prozent)", get_unique_values_pct(ds)],
-        ["Fehlende Werte (Prozent)", get_null_values_pct(ds)],
-        ["Spalten ohne Werte (n)", ds.isna().all().sum()],
+        ["Datengröße in Kilobytes", memory_size],
+        ["Distinkte Werte (Prozent)", _unique_values_pct(numeric, na)],
+        ["Fehlende Werte (Prozent)", _null_values_pct(na)],
+        ["Spalten ohne Werte (n)", na.all(axis=0).sum()],
         ["Datentypen", get_data_types(ds).items()],
         ["Spalten mit exakt selben Werten", get_duplicated_columns(ds)],
-        ["Überprüfung Aggregationsspalte", check_aggregation(ds, geo)],
+        ["Überprüfung Aggregationsspalte", _check_aggregation(numeric, geo)],
         ["Open Data Schema", fivestar_opendata(ds_md)],
-        ["Überprüfung des Wertebereichs", check_units(ds, ds_md)],
+        ["Überprüfung des Wertebereichs", _check_units(numeric, ds_md)],
         ["Herausgeber-Kategorie", categorize_source(ds_md)],
         ["Domain-Check", no_country],
         #["Zeit seit Erstellung in Monaten", check_months_since_upload(ds_md)],
@@ -90,6 +99,23 @@ def describe_ds_as_dataframe(ds: pd.DataFrame, ds_md: dict) -> pd.DataFrame:
     return profile
 
 
+def _categorize_object_columns(ds: pd.DataFrame) -> pd.DataFrame:
+    """ converts object columns with few distinct values to category dtype, so later checks compare
+        integer codes instead of python objects; the memory size is therefore taken before conversion
+    Args:
+        ds: the DataFrame to convert
+    Returns:
+        A copy of the DataFrame with categorical columns, or the DataFrame itself if there are no object columns
+    """
+    object_columns = ds.select_dtypes(include='object').columns
+    if object_columns.empty:
+        return ds
+    ds = ds.copy()
+    for column in object_columns:
+        if ds[column].nunique() / max(len(ds), 1) < CATEGORY_RATIO:
+            ds[column] = ds[column].astype('category')
+    return ds
+
 def get_null_values_pct(ds: pd.DataFrame) -> float:
     """ checks the percentage of null values in dataset
     Args:
@@ -97,10 +123,18 @@ def get_null_values_pct(ds: pd.DataFrame) -> float:
     Returns:
        the percentage of null values
     """
-    if not ds.empty:
-        ds_list_filtered = utils.list_of_numbers_in_ds(ds)
-        null_vals = np.isnan(ds_list_filtered).sum()
-        null_vals_percent = null_vals / len(ds.values.flatten())
+    return _null_values_pct(_numeric_frame(ds).isna())
+
+def _null_values_pct(na: pd.DataFrame) -> float:
+    """ checks the percentage of null values in dataset
+    Args:
+        na: the missing value mask of the numeric dataset
+    Returns:
+       the percentage of null values
+    """
+    if not na.empty:
+        null_vals = na.to_numpy(dtype=bool).sum()
+        null_vals_percent = null_vals / na.size
         if null_vals_percent:
             return null_vals_percent*TO_PERCENT
     else:
@@ -113,19 +147,37 @@ def get_unique_values_pct(ds: pd.DataFrame) -> float:
     Returns:
        the percentage of unique values
     """
-    # a list of all number values in dataframe
-    ds_as_list_numeric = np.array(utils.list_of_numbers_in_ds(ds))
-    #drop nan values from numpy array element
-    ds_as_list_without_na = ds_as_list_numeric[~np.isnan(ds_as_list_numeric)]
-
-    if len(ds_as_list_without_na) > 0:
-        unique_vals = np.unique(ds_as_list_without_na)
-        unique_vals_percent = (len(unique_vals) / len(ds_as_list_without_na))
+    numeric = _numeric_frame(ds)
+    return _unique_values_pct(numeric, numeric.isna())
+
+def _unique_values_pct(numeric: pd.DataFrame, na: pd.DataFrame) -> float:
+    """ checks the percentage of unique values in dataset
+    Args:
+        numeric: the numeric dataset
+        na: the missing value mask of the numeric dataset
+    Returns:
+       the percentage of unique values
+    """
+    #drop nan values, leaving a flat numpy array
+    ds_numeric_without_na = numeric.to_numpy(dtype=float)[~na.to_numpy(dtype=bool)]
+
+    if ds_numeric_without_na.size > 0:
+        unique_vals = np.unique(ds_numeric_without_na)
+        unique_vals_percent = (unique_vals.size / ds_numeric_without_na.size)
         if unique_vals_percent:
             return unique_vals_percent*TO_PERCENT
     else:
         logging.info("Distinkte Werte (Prozent) -> leerer oder nicht-numerischer Datensatz")
 
+def _numeric_frame(ds: pd.DataFrame) -> pd.DataFrame:
+    """ turn given DataFrame into numeric DataFrame, non-numeric values become NaN
+    Args:
+        ds: the DataFrame to transform
+    Returns:
+        A DataFrame with the same index and columns containing only numeric values
+    """
+    return ds.apply(pd.to_numeric, errors='coerce')
+
 def get_memory_size(ds: pd.DataFrame) -> float:
     """ retrieves memory size of dataframe and hence dataset
     Args:
@@ -133,7 +185,7 @@ def get_memory_size(ds: pd.DataFrame) -> float:
     Returns:
        the used memory size of the dataset
     """
-    memory_size = ds.memory_usage(index=False).sum()
+    memory_size = ds.memory_usage(index=False, deep=True).sum()
     if memory_size<KB:
         return memory_size
     else:
@@ -149,12 +201,30 @@ def get_duplicated_columns(ds: pd.DataFrame) -> list:
     """
     ds = ds.dropna(axis=1, how="all")
     if len(ds) > 0:
-        duplicated_columns = ds.T.duplicated(keep=False)
-        list_duplicate_columns = list(duplicated_columns[duplicated_columns].index)
+        # fingerprint every column by position, so only columns with equal hashes need to be compared
+        hashes = pd.Series([_column_hash(ds.iloc[:, i]) for i in range(ds.columns.size)])
+        candidates = hashes[hashes.duplicated(keep=False)]
+        duplicated_columns = pd.Series(False, index=hashes.index)
+        for _, bucket in candidates.groupby(candidates):
+            # verify equality within bucket to rule out hash collisions
+            duplicated_columns[bucket.index] = ds.iloc[:, bucket.index].T.duplicated(keep=False).values
+        list_duplicate_columns = list(ds.columns[duplicated_columns.values])
         return list_duplicate_columns
     else:
         logging.info("Spalten mit exakt selben Werten -> keine überprüfbaren Daten in Datensatz")
 
+def _column_hash(dc: pd.Series) -> int:
+    """ fingerprints the values of a column; numeric columns are hashed as float64, so that
+        int and float columns with the same values get the same hash
+    Args:
+        dc: the Series to hash
+    Returns:
+        the hash of the column values
+    """
+    if is_numeric_dtype(dc):
+        dc = dc.astype('float64')
+    return pd.util.hash_pandas_object(dc, index=False).sum()
+
 def get_time_range_ds(ds: pd.DataFrame) -> list:
     """ check which timeframe (minimum - maximum) there is at least one value for in dataframe
     Args:
@@ -164,9 +234,9 @@ def get_time_range_ds(ds: pd.DataFrame) -> list:
     """
     ds_time_range = []
     if isinstance(ds.index, pd.core.indexes.datetimes.DatetimeIndex):
-        min_time = ds.dropna(how='all').index.min().date()
-        max_time = ds.dropna(how='all').index.max().date()
-        ds_time_range = [min_time, max_time]
+        # dates of all rows with at least one value, without copying the dataset
+        dates = ds.index[ds.notna().any(axis=1).values]
+        ds_time_range = [dates.min().date(), dates.max().date()]
     else:
         logging.info("Zeitraum -> keine Zeitreihen in Datensatz")
     return ds_time_range
@@ -179,22 +249,17 @@ def get_data_types(ds: pd.DataFrame) -> dict:
     Returns:
         A dictionary with the amount of numeric, string and constant values
     """
-    num = 0
-    string = 0
-    const = 0
-
-    for column in ds.columns:
-        if ds[column].nunique() == 0:
-            const += 1
-        elif is_numeric_dtype(ds[column]):
-            num += 1
-        elif is_string_dtype(ds[column]):
-            string += 1
+    nuniques = ds.nunique(dropna=True).values
+    column_dtypes = list(ds.dtypes)
+    is_num = np.array([is_numeric_dtype(dtype) for dtype in column_dtypes], dtype=bool)
+    is_string = np.array([is_string_dtype(dtype) or is_categorical_dtype(dtype) for dtype in column_dtypes],
+                         dtype=bool)
+    has_values = nuniques > 0
 
     dtypes = {
-        "NUM": num,
-        "STRING": string,
-        "CONST": const
+        "NUM": int((is_num & has_values).sum()),
+        "STRING": int((is_string & ~is_num & has_values).sum()),
+        "CONST": int((~has_values).sum())
     }
 
     return dtypes
@@ -254,7 +319,7 @@ def check_domain(ds: pd.DataFrame) -> [list, list]:
     iso_list = []
     if 'country' in ds.columns.name.lower():
         for country in ds.columns:
-            iso, fuzzy = Country.get_iso3_country_code_fuzzy(country, use_live=False)
+            iso, fuzzy = _iso_lookup(country)
             if iso is None:
                 country_type = utils.check_country_fsp(country)
                 if country_type is None:
@@ -265,6 +330,16 @@ def check_domain(ds: pd.DataFrame) -> [list, list]:
                 iso_list.append(iso)
     return not_a_country, iso_list
 
+@functools.lru_cache(maxsize=4096)
+def _iso_lookup(country: str) -> tuple:
+    """ fuzzy matches a column header to an iso-code, memoized as the same headers recur across datasets
+    Args:
+        country: the column header to match
+    Returns:
+        A tuple of iso-code (or None) and whether the match was fuzzy
+    """
+    return Country.get_iso3_country_code_fuzzy(country, use_live=False)
+
 def check_regions(iso_list: list) -> list:
     """ check which regions are available in dataset or if it has data for all continents -> World
     Args:
@@ -272,10 +347,9 @@ def check_regions(iso_list: list) -> list:
     Returns:
         A set with regions available in the dataset
     """
-    regions = set()
     if iso_list:
-        for cc in REGION_CODE.keys():
-            [regions.add(REGION_CODE[cc]) for iso in iso_list if iso in Country.get_countries_in_region(cc, use_live=False)]
+        iso_to_region = _iso_to_region()
+        regions = {iso_to_region[iso] for iso in iso_list if iso in iso_to_region}
         if regions == set(REGION_CODE.values()):
             return ["Welt"]
         if not regions:
@@ -285,6 +359,15 @@ def check_regions(iso_list: list) -> list:
         return ["N/A"]
     return list(sorted(regions))
 
+@functools.lru_cache(maxsize=1)
+def _iso_to_region() -> dict:
+    """ builds lookup of every country in REGION_CODE to its region, once per session
+    Returns:
+        A dict with iso-codes as keys and region names as values
+    """
+    return {iso: region for cc, region in REGION_CODE.items()
+            for iso in Country.get_countries_in_region(cc, use_live=False)}
+
 def check_interval(ds: pd.DataFrame) -> str:
     """ check the periodicity of the dataframe when more than two rows in dataset
     Args:
@@ -316,18 +399,30 @@ def check_aggregation(ds: pd.DataFrame, geo: list) -> list:
     Returns:
         A list of years in which the aggregation doesn't add up
     """
+    return _check_aggregation(_numeric_frame(ds), geo)
+
+def _check_aggregation(numeric: pd.DataFrame, geo: list) -> list:
+    """ if dataset contains Countries, has more than one column including a column named "World",
+        check whether the value of the average or sum of the rest of the column adds up
+    Args:
+        numeric: the numeric DataFrame to check the values in
+    Returns:
+        A list of years in which the aggregation doesn't add up
+    """
     agg_violation = []
-    if "World" in ds.columns and len(ds.columns) > 1:
+    if "World" in numeric.columns and len(numeric.columns) > 1:
         if "Welt" in geo:
-            for index, row in ds.iterrows():
-                numeric_rows_filled_zeroes = pd.to_numeric(row, errors='coerce')
-                all_countries_mean = (numeric_rows_filled_zeroes[ds.columns != "World"].mean())
-                all_countries_sum = (numeric_rows_filled_zeroes[ds.columns != "World"].sum())
-                world = numeric_rows_filled_zeroes[ds.columns == "World"].sum()
-                if [all_countries_mean != world or all_countries_sum != world]:
-                    agg_violation.append(index)
-                if len(agg_violation) == len(ds.index):
-                    agg_violation = ["alle Zeilen"]
+            world = numeric["World"]
+            all_countries = numeric.drop(columns=["World"])
+            all_countries_mean = all_countries.mean(axis=1)
+            all_countries_sum = all_countries.sum(axis=1)
+            # a row only violates the aggregation if World matches neither the mean nor the sum
+            mean_matches = np.isclose(all_countries_mean, world, rtol=AGGREGATION_RTOL)
+            sum_matches = np.isclose(all_countries_sum, world, rtol=AGGREGATION_RTOL)
+            violated = ~mean_matches & ~sum_matches
+            agg_violation = numeric.index[violated].tolist()
+            if len(agg_violation) == len(numeric.index):
+                agg_violation = ["alle Zeilen"]
         else:
             logging.info("Überprüfung Aggregationsspalte -> Aggregation nicht überprüfbar")
     else:
@@ -343,17 +438,30 @@ def check_units(ds: pd.DataFrame, ds_md: dict) -> list:
     Returns:
         A list of columns where at least one value violates range of provided unit
     """
+    return _check_units(_numeric_frame(ds), ds_md)
+
+def _check_units(numeric: pd.DataFrame, ds_md: dict) -> list:
+    """ check whether any numeric values in DataFrame are out of range for the given unit
+    Args:
+        numeric: the numeric DataFrame to check the values for
+        ds_md: A dictionary with the online provided metadata
+    Returns:
+        A list of columns where at least one value violates range of provided unit
+    """
     violates_unit = []
 
     unit_to_max_num = MAX_UNITS.get(ds_md["Dateneinheit"])
     unit_to_min_num = MIN_UNITS.get(ds_md["Dateneinheit"])
 
-    for column in ds.columns:
-        test = pd.to_numeric(ds[column], errors='coerce').fillna(0)
-        if str(unit_to_min_num) and (test < unit_to_min_num).any():
-            violates_unit.append(column)
-        if str(unit_to_max_num) and (test >= unit_to_max_num).any():
-            violates_unit.append(column)
+    if unit_to_min_num is None and unit_to_max_num is None:
+        return violates_unit
+
+    violated = pd.Series(False, index=numeric.columns)
+    if unit_to_min_num is not None:
+        violated |= (numeric < unit_to_min_num).any(axis=0)
+    if unit_to_max_num is not None:
+        violated |= (numeric >= unit_to_max_num).any(axis=0)
+    violates_unit = numeric.columns[violated.values].tolist()
     return violates_unit
 
 def check_months_since_upload(ds_md: dict) -> str:
@@ -366,9 +474,8 @@ def check_months_since_upload(ds_md: dict) -> str:
     if not ds_md["Erstellungsdatum"] or ds_md['Erstellungsdatum']=='N/A':
         delay_upload = "N/A"
     else:
-        delay_upload = str(len(pd.date_range(
-            start=pd.to_datetime(ds_md["Erstellungsdatum"], format='%Y'),
-            end=pd.to_datetime("now"), freq='M')))
+        upload_date = pd.to_datetime(ds_md["Erstellungsdatum"], format='%Y')
+        delay_upload = str(_months_between(upload_date, pd.Timestamp.now()))
 
     #doc_create = ds_md["Erstellungsdatum"] if ds_md["Erstellungsdatum"] != "" else "N/A"
     #delay = {"doc_create_date": doc_create, "delay_upload_in_months": delay_upload}
@@ -387,17 +494,27 @@ def check_delay_upload(ds: pd.DataFrame, ds_md: dict) -> str:
         delay = "N/A"
     else:
         upload_date = pd.to_datetime(ds_md["Erstellungsdatum"], format='%Y')
-        clean_dataset = ds.dropna(axis=1, how='all')
-        if len(clean_dataset)>0:
-            last_date = clean_dataset.index.max()
-            if last_date.year > upload_date.year:
-                delay = "+" + str(len(pd.date_range(start= upload_date, end= last_date, freq='M')))
-            elif upload_date.year == last_date.year:
-                delay = str(len(pd.date_range(start=last_date, end= upload_date, freq='M')))
+        # dropping empty columns keeps all rows, so the index of the dataset itself is checked
+        if len(ds.index)>0:
+            last_date = ds.index.max()
+            months = _months_between(upload_date, last_date)
+            if months > 0:
+                delay = "+" + str(months)
+            elif months < 0:
+                delay = "-" + str(abs(months))
             else:
-                delay = "-" + str(len(pd.date_range(start=last_date, end= upload_date, freq='M')))
+                delay = str(months)
         else:
             delay = "N/A"
             logging.info("Verzögerung Veröffentlichung -> Datensatz hat keine lesbaren Werte")
     return delay
 
+def _months_between(start, end) -> int:
+    """ counts the calendar months from start to end, negative if end lies before start
+    Args:
+        start: first date
+        end: second date
+    Returns:
+        the difference in months
+    """
+    return (end.year - start.year) * 12 + (end.month - start.month)
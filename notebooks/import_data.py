@@ -5,11 +5,12 @@
 
 __author__ = "Lisa Koeritz"
 
+import functools
 import logging
 import pandas as pd
 import requests
 import json
-import urllib
+from requests.adapters import HTTPAdapter
 from bs4 import BeautifulSoup
 
 import wbdata
@@ -23,6 +24,35 @@ known_datasets_from_wb = {}
 
 metadata_list = {"Quelle","Erstellungsdatum","Kategorie","Titel","Beschreibung","Herausgeber","ID","Dateneinheit"} # basic eGMS attribute structure
 
+TIMEOUT = 10
+
+# shared session, so repeated requests to the same host reuse their connection
+_SESSION = requests.Session()
+_SESSION.mount('http://', HTTPAdapter(pool_connections=8, pool_maxsize=16))
+_SESSION.mount('https://', HTTPAdapter(pool_connections=8, pool_maxsize=16))
+
+# eGMS attribute -> World Bank metadata id
+WB_MAP = {
+    "Quelle": "Source",
+    "Kategorie": "Topic",
+    "Titel": "IndicatorName",
+    "Beschreibung": "Longdefinition",
+    #"zeitl. Abdeckung": "Periodicity",
+}
+
+@functools.lru_cache(maxsize=None)
+def _download(url: str) -> bytes:
+    """ downloads the given url through the shared session; only successful responses are cached,
+        errors are raised and the download is retried on the next call
+    Args:
+        url: url to download
+    Returns:
+        the content of the response
+    """
+    response = _SESSION.get(url, timeout=TIMEOUT)
+    response.raise_for_status()
+    return response.content
+
 ADDITIONAL_URLS = {
     'Commodities Futures Data': 'http://www.foodsecurityportal.org/api/commodities-futures-.csv',
     'Weekly Commodities Prices': 'http://www.foodsecurityportal.org/api/weekly-commodities-p.csv',
@@ -37,8 +67,7 @@ def collect_all_dataset_links_fsp() -> dict:
     """
     try:
         base_url = 'http://www.foodsecurityportal.org/api/countries'
-        response = requests.get(base_url)
-        soup = BeautifulSoup(response.text, 'html.parser')
+        soup = BeautifulSoup(_download(base_url), 'lxml')
         download_links = {}
         for link in soup.findAll(lambda opt: opt.name == 'option' and opt.parent.attrs.get('id') == 'edit-table-path'):
             if link.get('value') == '':
@@ -62,9 +91,12 @@ def collect_all_metadata_links_fsp() -> dict:
         A dict with titles as keys and link paths as values
     """
     url = 'http://www.foodsecurityportal.org/api'
-    response = requests.get(url)
-    soup = BeautifulSoup(response.text, 'html.parser')
     metadataList = {}
+    try:
+        soup = BeautifulSoup(_download(url), 'lxml')
+    except requests.exceptions.HTTPError:
+        logging.critical("no metadata connection")
+        return metadataList
     for link in soup.findAll('span', attrs={'class': 'field-content field-title'}):
         metadataLink = 'http://www.foodsecurityportal.org' + link.a['href']
         title = link.getText()
@@ -85,8 +117,7 @@ def get_metadata_attributes_fsp(url) -> dict:
     metadata_dict = dict.fromkeys(metadata_list, 'N/A')
     if not "N/A" in url:
         try:
-            html = urllib.request.urlopen(url).read()
-            soup = BeautifulSoup(html, 'lxml')
+            soup = BeautifulSoup(_download(url), 'lxml')
             title = soup.find('h6', attrs={'class': 'page-title'}).getText()
             metadata_dict["Titel"] = title
             for information in soup.find_all('div', attrs={'class': 'field-type-text'}):
@@ -105,7 +136,7 @@ def get_metadata_attributes_fsp(url) -> dict:
                 #    metadata_dict[label] = attribute
             description = soup.find('div', attrs={'class': 'filter-text'}).get_text().strip("\n")
             metadata_dict["Beschreibung"] = description
-        except (urllib.error.HTTPError, KeyError):
+        except (requests.exceptions.HTTPError, KeyError):
             pass
         except TypeError:
             logging.info("URL Parameter ist notwendig")
@@ -125,7 +156,8 @@ def get_dataset_fsp(url) -> pd.DataFrame:
         return known_datasets_from_fsp[url]
     else:
         try:
-            dataset = pd.read_csv(url, index_col=0).T
+            # transposing a frame with any non-numeric column yields object columns only, so restore numeric dtypes
+            dataset = pd.read_csv(url, index_col=0).T.infer_objects()
             if dataset.empty:
                 logging.info("given url doesn't exist in api")
                 raise RuntimeWarning("Seems to have a broken link")
@@ -149,25 +181,21 @@ def get_metadata_attributes_wb(ind) -> dict:
     metadata_dict = dict.fromkeys(metadata_list, 'N/A')
     try:
         api_url = 'https://api.worldbank.org/v2/sources/2/series/' + ind + '/metadata?format=json'
-        request = requests.get(api_url)
-        values = utils.extract_json_values(request.json(), 'value')
-        ids = utils.extract_json_values(request.json(), 'id')
+        metadata_json = json.loads(_download(api_url))
+        json_values = utils.extract_json_values_multi(metadata_json, ('value', 'id'))
+        values = json_values['value']
+        ids = json_values['id']
         meta_schema_dict = dict(zip(ids[3:], values))
 
+        metadata_dict.update({key: meta_schema_dict.get(wb_key, 'N/A') for key, wb_key in WB_MAP.items()})
         metadata_dict["Herausgeber"] = "World Bank"
-        #metadata_dict["zeitl. Abdeckung"] = (meta_schema_dict["Periodicity"] if ("Periodicity" in meta_schema_dict.keys()) else "N/A")
-        metadata_dict["Quelle"] = (meta_schema_dict["Source"] if ("Source" in meta_schema_dict.keys()) else "N/A")
-        metadata_dict["Kategorie"] = (meta_schema_dict["Topic"] if ("Topic" in meta_schema_dict.keys()) else "N/A")
-        metadata_dict["Titel"] = (meta_schema_dict["IndicatorName"] if ("IndicatorName" in meta_schema_dict.keys()) else "N/A")
-        metadata_dict["Beschreibung"] = (
-            meta_schema_dict["Longdefinition"] if ("Longdefinition" in meta_schema_dict.keys()) else "N/A")
         metadata_dict["ID"] = ind
         # metadata_dict["Lizenz"] = meta_schema_dict["License_Type"]
         # metadata_dict["Methodik"] = meta_schema_dict["Statisicalconceptandmethodology"]
     except KeyError:
         logging.info("fehlender Indikator")
         pass
-    except json.decoder.JSONDecodeError:
+    except (json.decoder.JSONDecodeError, requests.exceptions.HTTPError):
         logging.warning("keine Informationen für gegebenen Indikator vorhanden")
         pass
     return metadata_dict
@@ -5,10 +5,26 @@
 
 __author__ = "Lisa Koeritz"
 
-import pandas as pd
+import functools
 import logging
+import os
+import re
+import tempfile
+import time
+import pandas as pd
+
+COUNTRY_LIST_URL = 'http://www.foodsecurityportal.org/api/countries.csv'
+# per-user cache directory, the file is fetched again once it is older than COUNTRY_LIST_MAX_AGE seconds
+COUNTRY_LIST_CACHE = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'),
+                                  'voila_DataProfiling', 'fsp_countries.csv')
+COUNTRY_LIST_MAX_AGE = 7 * 24 * 60 * 60
 
-country_list = pd.read_csv('http://www.foodsecurityportal.org/api/countries.csv', index_col=0)
+DATETIME_FORMATS = (
+    (re.compile(r'^\d{4}$'), '%Y'),
+    (re.compile(r'^[A-Za-z]{3} \d{2}$'), '%b %y'),
+    (re.compile(r'^\d{4}-\d{2}$'), '%Y-%m'),
+    (re.compile(r'^\d{1,2}/\d{1,2}/\d{4}$'), '%m/%d/%Y'),
+)
 
 def datetimeIndex_parsing(index):
     """ turn given index into DateTimeIndex
@@ -17,7 +33,13 @@ def datetimeIndex_parsing(index):
     Returns:
         DateTimeIndex or unformatted index
     """
-    for fmt in ('%Y', '%b %y', '%Y-%m', '%m/%d/%Y'):
+    formats = [fmt for pattern, fmt in DATETIME_FORMATS]
+    if len(index) > 0:
+        # the format matching the first label is tried first, the others follow in their usual order
+        sample = str(index[0])
+        matching = [fmt for pattern, fmt in DATETIME_FORMATS if pattern.match(sample)]
+        formats = matching + [fmt for fmt in formats if fmt not in matching]
+    for fmt in formats:
         try:
             return pd.to_datetime(index, format=fmt)
         except ValueError:
@@ -27,47 +49,32 @@ def datetimeIndex_parsing(index):
 
 ### source: https://hackersandslackers.com/extract-data-from-complex-json-python/ ###
 ### aufgerufen am 06.07.2019 ###
-def extract_json_values(obj, key):
-    """dissolve deeply nested json in readable json values
+def extract_json_values_multi(obj, keys) -> dict:
+    """dissolve deeply nested json in readable json values for several keys in a single walk
     Args:
         obj: JSON object to dissolve
-        key: id to dissolve for
-    Returns:
-        JSON object dissolved for given key
-    """
-    arr = []
-
-    def extract(obj, arr, key):
-        """Recursively search for values of key in JSON tree."""
-        if isinstance(obj, dict):
-            for k, v in obj.items():
-                if isinstance(v, (dict, list)):
-                    extract(v, arr, key)
-                elif k == key:
-                    arr.append(v)
-        elif isinstance(obj, list):
-            for item in obj:
-                extract(item, arr, key)
-        return arr
-
-    results = extract(obj, arr, key)
-    return results
-
-def list_of_numbers_in_ds(ds: pd.DataFrame) -> list:
-    """ turn given DataFrame into list with only the numeric(float or int) values present
-    Args:
-        ds: DataFrame to transform
+        keys: ids to dissolve for
     Returns:
-        list of only numeric values or empty list if empty
+        A dict with a list of values in document order for each given key
     """
-    try:
-        ds_list = ds.values.flatten()
-        filtered_list = filter(lambda i: isinstance(i, (int, float)), ds_list)
-    except TypeError:
-        filtered_list = ""
-        logging.info("leerer Datensatz vorhanden")
-    return list(filtered_list)
+    values = {key: [] for key in keys}
+    # stack of iterators over (key, value) pairs, so nodes are visited in document order without recursion
+    stack = [iter([(None, obj)])]
+    while stack:
+        for k, v in stack[-1]:
+            if isinstance(v, dict):
+                stack.append(iter(v.items()))
+                break
+            elif isinstance(v, list):
+                stack.append((None, item) for item in v)
+                break
+            elif k in values:
+                values[k].append(v)
+        else:
+            stack.pop()
+    return values
 
+@functools.lru_cache(maxsize=None)
 def check_country_fsp(not_a_country: str) -> str:
     """ uses given country list from Food Security Portal and returns Domain-Type place belongs to if possible
     Args:
@@ -75,6 +82,62 @@ def check_country_fsp(not_a_country: str) -> str:
     Returns:
         domain given place belongs to if available
     """
-    if not_a_country in country_list.index and country_list.loc[not_a_country, "Type"] != "Country":
-        return country_list.loc[not_a_country, "Type"]
+    country_type = _country_types().get(not_a_country)
+    if country_type is not None and country_type != "Country":
+        return country_type
 
+@functools.lru_cache(maxsize=1)
+def _country_types() -> dict:
+    """ turns the country list from Food Security Portal into a lookup table
+    Returns:
+        A dict with places as keys and their Domain-Type as values
+    """
+    return _country_list()["Type"].to_dict()
+
+@functools.lru_cache(maxsize=1)
+def _country_list() -> pd.DataFrame:
+    """ loads the country list from Food Security Portal on first use, from local cache file if available and recent
+    Returns:
+        DataFrame with places as index and their Domain-Type in column "Type"
+    """
+    country_list = _read_country_list_cache()
+    if country_list is None:
+        country_list = pd.read_csv(COUNTRY_LIST_URL, index_col=0)
+        _write_country_list_cache(country_list)
+    country_list["Type"] = country_list["Type"].astype('category')
+    return country_list
+
+def _read_country_list_cache() -> pd.DataFrame:
+    """ reads the cached country list
+    Returns:
+        DataFrame of the cached country list, None if the cache file is missing, outdated or unreadable
+    """
+    try:
+        if time.time() - os.path.getmtime(COUNTRY_LIST_CACHE) > COUNTRY_LIST_MAX_AGE:
+            return None
+        country_list = pd.read_csv(COUNTRY_LIST_CACHE, index_col=0)
+    except (OSError, ValueError):
+        return None
+    if "Type" not in country_list.columns:
+        logging.info("Länderliste im Cache unvollständig -> wird neu geladen")
+        return None
+    return country_list
+
+def _write_country_list_cache(country_list: pd.DataFrame):
+    """ writes the country list to the cache file; written to a temporary file first and moved into place,
+        so readers never see a partially written file
+    Args:
+        country_list: DataFrame of the country list to cache
+    """
+    cache_dir = os.path.dirname(COUNTRY_LIST_CACHE)
+    tmp_path = None
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.csv')
+        with os.fdopen(fd, 'w') as tmp_file:
+            country_list.to_csv(tmp_file)
+        os.replace(tmp_path, COUNTRY_LIST_CACHE)
+    except OSError:
+        logging.info("Länderliste konnte nicht zwischengespeichert werden")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)